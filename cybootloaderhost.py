@@ -17,14 +17,23 @@
 
 
 import argparse
-import binascii
+import struct
 import sys
 
 import hid
 
 
 class Bootloader():
-    MAX_DATA_LENGTH = 64-7-9
+    PACKET_LENGTH = 64
+    MAX_DATA_LENGTH = PACKET_LENGTH-7-9
+
+    # Checksum contribution of a full-length "Send Data" packet's header
+    SEND_DATA_HEADER_SUM = 0x01 + 0x37 + (MAX_DATA_LENGTH & 0xff) + (MAX_DATA_LENGTH >> 8)
+
+    # A full-length "Send Data" packet with zeroed data and checksum
+    SEND_DATA_TEMPLATE = (bytes((0x01, 0x37, MAX_DATA_LENGTH & 0xff, MAX_DATA_LENGTH >> 8)) +
+                          bytes(MAX_DATA_LENGTH + 2) + b"\x17" +
+                          bytes(PACKET_LENGTH - MAX_DATA_LENGTH - 7))
 
     STATUSES = {
         0x00: "CYRET_SUCCESS",
@@ -40,32 +49,31 @@ class Bootloader():
         0x0f: "BOOTLOADER_ERR_UNK"
     }
 
-    def __init__(self, vid=0, pid=0, serial=None):
-        try:
-            self._device = hid.device()
-            self._device.open(vid, pid)
-        except OSError as error:
-            sys.stderr.write("Error: {}".format(error))
+    def __init__(self, device):
+        self._device = device
 
         self.jtag_id = None
         self.device_revision = None
         self.bootloader_revision = None
 
-    def _checksum(self, data):
+    @classmethod
+    def _checksum(cls, data):
         '''16-bit packet checksum.
 
+        The builtin sum() over a bytes object is the fastest way to add up a
+        packet's worth of bytes in CPython; summing a bytearray or a
+        memoryview is noticeably slower, and an explicit Python loop is
+        slower still. Prefer passing bytes here.
+
         :param data: The data to sum
         :type data: bytes or list of 8-bit integers
         :returns: checksum
         :rtype: int
         '''
-        checksum = 0
-        for byte in data:
-            checksum += byte
-        checksum = (~checksum + 1) & 0xffff
-        return checksum
+        return (-sum(data)) & 0xffff
 
-    def _make_packet(self, command, data=[]):
+    @classmethod
+    def _make_packet(cls, command, data=b""):
         '''Generates a packet to send the bootloader.
 
         :param command: The command to send
@@ -73,26 +81,47 @@ class Bootloader():
         :param data: The data to send
         :type data: bytes or list of 8-bit integers
         :returns: Packet data
-        :rtype: list of 8-bit integers
+        :rtype: bytearray
         '''
-        packet = []
-        packet.append(0x01)
-
-        packet.append(command)
-
         data_length = len(data)
-        assert data_length <= (64 - 7)
-        packet.append(data_length & 0xff)
-        packet.append(data_length >> 8)
+        if data_length > (cls.PACKET_LENGTH - 7):
+            raise ValueError("Packet data too long: {} bytes".format(data_length))
+
+        packet = bytearray(cls.PACKET_LENGTH)
+        packet[0] = 0x01
+        packet[1] = command
+        packet[2] = data_length & 0xff
+        packet[3] = data_length >> 8
+        if data_length:
+            packet[4:4+data_length] = data
+
+        checksum = (-(0x01 + command + (data_length & 0xff) + (data_length >> 8) + sum(data))) & 0xffff
+        packet[4+data_length] = checksum & 0xff
+        packet[4+data_length+1] = checksum >> 8
+
+        packet[4+data_length+2] = 0x17
+        return packet
+
+    @classmethod
+    def _fill_send_data(cls, packet, data):
+        '''Fills in a copy of SEND_DATA_TEMPLATE in place.
 
-        for byte in data:
-            packet.append(byte)
+        Only the data and checksum bytes are written; the header and end of
+        packet bytes are already set in the template.
 
-        checksum = self._checksum(packet)
-        packet.append(checksum & 0xff)
-        packet.append(checksum >> 8)
+        :param packet: A mutable copy of SEND_DATA_TEMPLATE
+        :type packet: bytearray
+        :param data: The data to send, exactly MAX_DATA_LENGTH bytes long
+        :type data: bytes or list of 8-bit integers
+        :returns: Packet data
+        :rtype: bytearray
+        '''
+        length = cls.MAX_DATA_LENGTH
+        packet[4:4+length] = data
 
-        packet.append(0x17)
+        checksum = (-(cls.SEND_DATA_HEADER_SUM + sum(data))) & 0xffff
+        packet[4+length] = checksum & 0xff
+        packet[4+length+1] = checksum >> 8
         return packet
 
     def _parse_response(self, response_data):
@@ -105,31 +134,32 @@ class Bootloader():
         '''
         response = {
             "status": "BOOTLOADER_ERR_UNK",
-            "data": [],
+            "data": b"",
             "checksum_ok": False,
         }
 
-        sop = response_data[0]
-        assert sop == 0x01
+        response_data = bytes(response_data)
+
+        data_length = int.from_bytes(response_data[2:4], "little")
 
-        response["status"] = self.STATUSES[response_data[1]]
+        # Leave short or badly framed responses marked bad. The checksum
+        # doesn't cover the end of packet byte, so it's checked here too.
+        if (len(response_data) < 7 + data_length or response_data[0] != 0x01 or
+                response_data[4+data_length+2] != 0x17):
+            return response
 
-        data_length = (response_data[3] << 8) | response_data[2]
+        response["status"] = self.STATUSES.get(response_data[1], "BOOTLOADER_ERR_UNK")
 
         if data_length > 0:
             response["data"] = response_data[4:4+data_length]
 
-        checksum_received = response_data[4+data_length]
-        checksum_received |= response_data[4+data_length+1] << 8
+        checksum_received = int.from_bytes(response_data[4+data_length:4+data_length+2], "little")
         checksum_calculated = self._checksum(response_data[:4+data_length])
         response["checksum_ok"] = (checksum_calculated == checksum_received)
 
-        eop = response_data[4+data_length+2]
-        assert eop == 0x17
-
         return response
 
-    def send_command(self, command, data=[]):
+    def send_command(self, command, data=b""):
         '''Sends a command with data to the bootloader.
 
         :param command: The command to send
@@ -142,7 +172,7 @@ class Bootloader():
         packet = self._make_packet(command, data)
         self._device.write(packet)
 
-        response_data = self._device.read(64)
+        response_data = self._device.read(self.PACKET_LENGTH)
         response = self._parse_response(response_data)
         return response
 
@@ -154,12 +184,10 @@ class Bootloader():
         '''
         response = self.send_command(0x38)
         if response["checksum_ok"] and response["status"] == "CYRET_SUCCESS":
-            self.jtag_id = response["data"][0]
-            self.jtag_id |= response["data"][1] << 8
-            self.jtag_id |= response["data"][2] << 16
-            self.jtag_id |= response["data"][3] << 24
-            self.device_revision = response["data"][4]
-            self.bootloader_revision = response["data"][5:8][::-1]
+            jtag_id, device_revision, rev_2, rev_1, rev_0 = struct.unpack_from("<IBBBB", response["data"], 0)
+            self.jtag_id = jtag_id
+            self.device_revision = device_revision
+            self.bootloader_revision = (rev_0, rev_1, rev_2)
             return True
         else:
             return False
@@ -176,8 +204,8 @@ class Bootloader():
         :returns: Success/failure
         :rtype: bool
         '''
-        arguments = [array_id, (row_number & 0xff), (row_number >> 8)]
-        response = self.send_command(0x39, arguments + data)
+        arguments = bytes((array_id, (row_number & 0xff), (row_number >> 8)))
+        response = self.send_command(0x39, arguments + bytes(data))
         if response["checksum_ok"] and response["status"] == "CYRET_SUCCESS":
             return True
         else:
@@ -193,7 +221,7 @@ class Bootloader():
         :returns: Success/failure
         :rtype: bool
         '''
-        arguments = [array_id, (row_number & 0xff), (row_number >> 8)]
+        arguments = bytes((array_id, (row_number & 0xff), (row_number >> 8)))
         response = self.send_command(0x34, arguments)
         if response["checksum_ok"] and response["status"] == "CYRET_SUCCESS":
             return True
@@ -216,28 +244,92 @@ class Bootloader():
 
     def exit_bootloader(self):
         '''Sends the "Exit Bootloader" command.'''
-        packet = self._make_packet(0x3b, [])
+        packet = self._make_packet(0x3b)
         self._device.write(packet)
 
-    def flash(self, firmware):
-        firmware_data = firmware.firmware
-        for row in firmware_data:
-            array_id = row[0]
-            row_number = row[1]
-            data = list(row[2])
-            if len(data) >= self.MAX_DATA_LENGTH:
-                full_packets = len(data)//self.MAX_DATA_LENGTH
-                partial_packet_length = len(data)%self.MAX_DATA_LENGTH
-                if partial_packet_length > 0:
-                    for i in range(0, full_packets):
-                        self.send_data(data[self.MAX_DATA_LENGTH*i:self.MAX_DATA_LENGTH*i+self.MAX_DATA_LENGTH])
-                    self.program_row(array_id, row_number, data[self.MAX_DATA_LENGTH*full_packets:self.MAX_DATA_LENGTH*full_packets+partial_packet_length])
-                else:
-                    for i in range(0, full_packets-1):
-                        self.send_data(data[self.MAX_DATA_LENGTH*i:self.MAX_DATA_LENGTH*i+self.MAX_DATA_LENGTH])
-                    self.program_row(array_id, row_number, data[self.MAX_DATA_LENGTH*(full_packets-1):self.MAX_DATA_LENGTH*(full_packets-1)+self.MAX_DATA_LENGTH])
-            else:
-                self.program_row(array_id, row_number, data)
+    @classmethod
+    def row_packets(cls, array_id, row_number, data):
+        '''Generates the packets needed to program a row of flash.
+
+        The row data is split into "Send Data" packets, with the last chunk
+        carried by a final "Program Row" packet.
+
+        :param array_id: The array_id of the row to program
+        :type array_id: 8-bit int
+        :param row_number: The row_number of the row to program
+        :type row_number: 16-bit int
+        :param data: The data to program
+        :type data: bytes or list of 8-bit integers
+        :returns: (packet, is_program_row) tuples
+        :rtype: list of tuples
+        '''
+        arguments = bytes((array_id, (row_number & 0xff), (row_number >> 8)))
+        # Slice as bytes, not a memoryview: summing bytes is much faster
+        data = bytes(data)
+        packets = []
+        length = cls.MAX_DATA_LENGTH
+        full_packets, partial_packet_length = divmod(len(data), length)
+        if partial_packet_length > 0:
+            send_packets = full_packets
+        else:
+            send_packets = max(full_packets - 1, 0)
+        for i in range(0, send_packets):
+            packet = cls._fill_send_data(bytearray(cls.SEND_DATA_TEMPLATE), data[length*i:length*(i+1)])
+            packets.append((packet, False))
+        packets.append((cls._make_packet(0x39, arguments + data[length*send_packets:]), True))
+        return packets
+
+    def flash(self, firmware, window=1):
+        '''Streams the firmware's precomputed packets to the bootloader.
+
+        Up to `window` packets are kept awaiting a response: before each
+        write, the oldest responses are read until there is room. "Program
+        Row" packets always wait for every outstanding response, since each
+        row must succeed before the next one is started.
+
+        :param firmware: The parsed firmware to flash
+        :type firmware: Cyacd
+        :param window: The maximum number of packets awaiting a response
+        :type window: int
+        :returns: Success/failure
+        :rtype: bool
+        '''
+        pending = 0
+        success = True
+        for packet, is_program_row in firmware.packets:
+            while success and pending >= window:
+                success = self._read_response_ok()
+                pending -= 1
+            if not success:
+                break
+
+            self._device.write(packet)
+            pending += 1
+
+            if is_program_row:
+                while pending > 0:
+                    if not self._read_response_ok():
+                        success = False
+                    pending -= 1
+                if not success:
+                    break
+
+        # Read every outstanding response, even after a failure, so none are
+        # left queued in the HID buffer
+        while pending > 0:
+            self._read_response_ok()
+            pending -= 1
+
+        return success
+
+    def _read_response_ok(self):
+        '''Reads one response from the bootloader.
+
+        :returns: Whether the response reports success
+        :rtype: bool
+        '''
+        response = self._parse_response(self._device.read(self.PACKET_LENGTH))
+        return response["checksum_ok"] and response["status"] == "CYRET_SUCCESS"
 
 class Cyacd():
     def __init__(self, firmware_file):
@@ -246,6 +338,7 @@ class Cyacd():
         self.silicon_revision = None
         self.checksum_type = None
         self.firmware = None
+        self.packets = None
 
     def _checksum(self, data):
         '''Single-byte flash row checksum.
@@ -255,77 +348,85 @@ class Cyacd():
         :returns: checksum
         :rtype: int
         '''
-        checksum = 0
-        for byte in data:
-            checksum += byte
-        checksum = (~checksum + 1) & 0xff
-        return checksum
+        return (-sum(data)) & 0xff
 
     def parse(self):
         '''Read's the firmware into a list of (array_id, row_number, data)
-        tuples.
+        tuples, and prebuilds the bootloader packets needed to flash it.
         '''
-        lines = self.file.readlines()
-
-        header_line = lines.pop(0).rstrip('\r\n')
-        header = binascii.a2b_hex(header_line)
-        self.silicon_id = header[3]
-        self.silicon_id |= header[2] << 8
-        self.silicon_id |= header[1] << 16
-        self.silicon_id |= header[0] << 24
+        header = bytes.fromhex(next(self.file))
+        self.silicon_id = int.from_bytes(header[0:4], "big")
         self.silicon_revision = header[4]
         self.checksum_type = header[5]
 
         firmware = []
-        for line in lines:
-            line = binascii.a2b_hex(line[1:].rstrip('\r\n'))
+        packets = []
+        bad_lines = []
+        for line_number, line in enumerate(self.file, 2):
+            if line.isspace():
+                continue
+            line = bytes.fromhex(line[1:])
+            data_length = int.from_bytes(line[3:5], "big")
+            # Each record ends with its own checksum, so a valid record is
+            # exactly as long as its header says and sums to zero
+            if len(line) != 6 + data_length or self._checksum(line):
+                bad_lines.append(line_number)
+                continue
             array_id = line[0]
-            row_number = (line[1] << 8) | line[2]
-            data_length = (line[3] << 8) | line[4]
+            row_number = int.from_bytes(line[1:3], "big")
             data = line[5:5+data_length]
-            checksum = line[5+data_length]
-            checksum_calculated = self._checksum(line[:-1])
-            assert checksum == checksum_calculated
             firmware.append((array_id, row_number, data))
+            packets.extend(Bootloader.row_packets(array_id, row_number, data))
+
+        if bad_lines:
+            raise ValueError("Bad record on lines: {}".format(", ".join(str(row) for row in bad_lines)))
 
         self.firmware = firmware
+        self.packets = packets
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("vid_pid_string", type=str, help="This is the same VID:PID string lsusb outputs. Example: 04b4:f13b")
     parser.add_argument("firmware_file", type=str, help="The name of the *.cyacd file you want to flash.")
+    parser.add_argument("-w", "--window", type=int, default=1, help="The number of data packets to send before waiting for responses. Default: 1")
     args = vars(parser.parse_args())
 
+    if args["window"] < 1:
+        parser.error("--window must be at least 1")
+
     vid_pid_string = args["vid_pid_string"].split(':')
 
     vid = int(vid_pid_string[0], 16)
     pid = int(vid_pid_string[1], 16)
 
-    # Search for a device with matching identifiers
-    found = False
-    for enumerated in hid.enumerate():
-        if enumerated["vendor_id"] == vid and enumerated["product_id"] == pid:
-            found = True
-            break
-
-    if found:
-        # Connect to the device's bootloader
-        bootloader = Bootloader(vid, pid)
-        bootloader.enter_bootloader()
-
-        # Load the firmware file
-        firmware = Cyacd(open(args["firmware_file"], 'r'))
-        firmware.parse()
-
-        # Make sure the firmware is being flashed to the correct chip
-        if (bootloader.jtag_id == firmware.silicon_id) and (bootloader.device_revision == firmware.silicon_revision):
-            bootloader.flash(firmware)
-
-        bootloader.exit_bootloader()
-    else:
-        sys.stderr.write("Device not found!\n")
+    # Open the device once and reuse the handle for the whole session
+    device = hid.device()
+    try:
+        device.open(vid, pid)
+    except OSError as error:
+        sys.stderr.write("Device not found: {}\n".format(error))
         sys.exit(1)
 
+    # Connect to the device's bootloader
+    bootloader = Bootloader(device)
+    bootloader.enter_bootloader()
+
+    # Load the firmware file
+    firmware = Cyacd(open(args["firmware_file"], 'r'))
+    firmware.parse()
+
+    # Make sure the firmware is being flashed to the correct chip
+    if (bootloader.jtag_id == firmware.silicon_id) and (bootloader.device_revision == firmware.silicon_revision):
+        if not bootloader.flash(firmware, args["window"]):
+            # Stay in the bootloader rather than starting a half-programmed
+            # application, so the flash can simply be retried
+            sys.stderr.write("Flashing failed!\n")
+            device.close()
+            sys.exit(1)
+
+    bootloader.exit_bootloader()
+    device.close()
+
 
 if __name__ == "__main__":
     main()